@@ -1,229 +1,434 @@
 import xarray as xr
 from tqdm import tqdm
-import os
 import numpy as np
+import numba
+import h5netcdf.legacyapi
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-import threading
-import sys
+from pathlib import Path
+import warnings
+
+OBS_CHUNK_SIZE = 1 << 20
+PROFILE_CHUNK_SIZE = 4096
+OBS_BUFFER_SIZE = 1 << 20
+# observation data budget for the whole host. A reader holds up to two chunks (one being filled, one being
+# written), so each reader flushes at FLUSH_THRESHOLD_BYTES // (2 * number of readers). Buffer slack from
+# GrowArray doubling and the per-profile lists come on top of this
+FLUSH_THRESHOLD_BYTES = 1 << 30
+FLUSH_CHECK_STRIDE = 1024  # power of two, the flush check only runs every FLUSH_CHECK_STRIDE profiles
+DATESTR_LENGTH = len("yyyy/mm/dd HH:MM:SS")
+MISSING_COLUMN = np.empty(0, dtype=np.float64)
+FLAG_FILL_VALUE = -127
+INT_FILL_VALUE = -2147483647  # netCDF's default int32 fill
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+# (output name, WOD variable name, output dtype) of the per-profile columns, an empty WOD name is filled in by the
+# reader. The dtype is fixed so every chunk has the same schema, WOD char arrays stay bytes
+STRING_ATTRS = (
+    ('orig_profile_ID', 'wod_unique_cast', np.int32),
+    ('orig_cruise_id', 'originators_cruise_identifier', bytes),
+    ('access_no', 'Access_no', np.int32),
+    ('platform', 'Platform', bytes),
+    ('station_no', 'Orig_Stat_Num', bytes),
+    ('instrument_type', 'dataset', bytes),
+    ('lat', 'lat', np.float32),
+    ('lon', 'lon', np.float32),
+    ('bottom_depth', 'Bottom_Depth', np.float32),
+    ('datestr', '', str),
+    ('timestamp', '', np.float64),
+    ('orig_filename', '', str),
+    ('shallowest_depth', '', np.float32),
+    ('deepest_depth', '', np.float32),
+)
+# value a missing entry of a per-profile column gets, by dtype kind
+MISSING_VALUES = {'f': np.nan, 'i': INT_FILL_VALUE, 'S': b'', 'U': ''}
+# (output name, WOD variable name, buffer dtype) of the per-observation columns, WOD stores measurements as float32.
+# WOD flags are small integers, they are kept as int8 with FLAG_FILL_VALUE for missing
+OBS_ATTRS = (
+    ('depth', 'z', np.float32),
+    ('press', 'Pressure', np.float32),
+    ('temp', 'Temperature', np.float32),
+    ('psal', 'Salinity', np.float32),
+    ('depth_flag', 'z_WODflag', np.int8),
+    ('temp_flag', 'Temperature_WODflag', np.int8),
+    ('psal_flag', 'Salinity_WODflag', np.int8),
+)
+OBS_ITEMSIZE = sum(np.dtype(dtype).itemsize for _, _, dtype in OBS_ATTRS)
+# every WOD variable read_raw_data touches, the prefetch threads load these into memory
+READ_VARIABLES = (tuple(wod_name for _, wod_name, _ in STRING_ATTRS if wod_name)
+                  + tuple(wod_name for _, wod_name, _ in OBS_ATTRS) + ('date', 'GMT_time', 'orig_filename'))
+
+
+class GrowArray:
+    # numpy buffer that doubles its capacity when it runs out (std::vector style), buf[:n] holds the data
+    __slots__ = ('buf', 'n')
+
+    def __init__(self, dtype, capacity=OBS_BUFFER_SIZE):
+        self.buf = np.empty(capacity, dtype=dtype)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def resize(self, size):
+        if size > self.buf.size:
+            buf = np.empty(max(size, 2 * self.buf.size), dtype=self.buf.dtype)
+            buf[:self.n] = self.buf[:self.n]
+            self.buf = buf
+        self.n = size
+
+    @property
+    def data(self):
+        return self.buf[:self.n]
+
+
+@numba.njit(cache=True)
+def _merge_column(out, start, n, values, fill_value):
+    # an empty values array marks a column that is missing from the file, nan values are replaced as well.
+    # read_raw_data skips files whose columns do not all have n values
+    if values.size == 0:
+        out[start:start + n] = fill_value
+        return
+    for k in range(n):
+        value = values[k]
+        out[start + k] = fill_value if value != value else value
+
+
+@numba.njit(cache=True)
+def _merge_profile(depth_buf, press_buf, temp_buf, psal_buf, depth_flag_buf, temp_flag_buf, psal_flag_buf, start, n,
+                   depth, press, temp, psal, depth_flag, temp_flag, psal_flag):
+    # write one profile's observations into the buffers at [start, start + n)
+    _merge_column(depth_buf, start, n, depth, np.nan)
+    _merge_column(press_buf, start, n, press, np.nan)
+    _merge_column(temp_buf, start, n, temp, np.nan)
+    _merge_column(psal_buf, start, n, psal, np.nan)
+    _merge_column(depth_flag_buf, start, n, depth_flag, FLAG_FILL_VALUE)
+    _merge_column(temp_flag_buf, start, n, temp_flag, FLAG_FILL_VALUE)
+    _merge_column(psal_flag_buf, start, n, psal_flag, FLAG_FILL_VALUE)
+
+
+@numba.njit(cache=True)
+def _days_from_civil(year, month, day):
+    # days since 1970-01-01 in the proleptic gregorian calendar (Howard Hinnant's days_from_civil)
+    if month <= 2:
+        year -= 1
+    era = (year if year >= 0 else year - 399) // 400
+    yoe = year - era * 400
+    doy = (153 * (month - 3 if month > 2 else month + 9) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+@numba.njit(cache=True)
+def _days_in_month(year, month):
+    if month == 2:
+        return 29 if (year % 4 == 0 and year % 100 != 0) or year % 400 == 0 else 28
+    return 30 if month in (4, 6, 9, 11) else 31
+
+
+@numba.njit(cache=True)
+def _write_digits(out, start, value, width):
+    for k in range(width - 1, -1, -1):
+        out[start + k] = 48 + value % 10
+        value //= 10
+
+
+@numba.njit(parallel=True, cache=True)
+def _decode_dates(dates, gmt_times, timestamps, datestrs):
+    # dates are yyyymmdd and gmt_times decimal hours; invalid entries are left as nan / empty
+    for k in numba.prange(dates.size):
+        timestamps[k] = np.nan
+        if not (np.isfinite(dates[k]) and np.isfinite(gmt_times[k])):
+            continue
+        date = int(dates[k])
+        year = date // 10000
+        month = date // 100 % 100
+        day = date % 100
+        hour = int(gmt_times[k] // 1)
+        minute = int((gmt_times[k] % 1) * 60)
+        if not (1 <= year <= 9999 and 1 <= month <= 12 and 1 <= day <= _days_in_month(year, month)
+                and 0 <= hour < 24 and 0 <= minute < 60):
+            continue
+        timestamps[k] = _days_from_civil(year, month, day) * 86400 + hour * 3600 + minute * 60
+        out = datestrs[k]
+        _write_digits(out, 0, year, 4)
+        out[4] = 47
+        _write_digits(out, 5, month, 2)
+        out[7] = 47
+        _write_digits(out, 8, day, 2)
+        out[10] = 32
+        _write_digits(out, 11, hour, 2)
+        out[13] = 58
+        _write_digits(out, 14, minute, 2)
+        out[16] = 58
+        _write_digits(out, 17, 0, 2)
 
 
 class WODReader:
-    def __init__(self):
-        pass
-
-    def is_variable_too_big(self, data_lists):
-        total_sum = 0
-        for key in data_lists:
-            total_sum += sys.getsizeof(data_lists[key])
-        size_mb = total_sum / (1024 * 1024)
-        # print(f"size mb: {size_mb}")
-        if size_mb >= 150:
-            return True
-        else:
-            return False
+    def __init__(self, max_workers=8, prefetch=32, flush_threshold_bytes=FLUSH_THRESHOLD_BYTES // 2):
+        self.max_workers = max_workers
+        self.prefetch = prefetch
+        # per reader: observation bytes a chunk may hold before it is written out
+        self.flush_threshold_bytes = flush_threshold_bytes
 
+    def is_variable_too_big(self):
+        # bytes_in counts the observation data held in the buffers, kept up to date in read_raw_data
+        return self.bytes_in >= self.flush_threshold_bytes
 
-    def get_date(self, ds):
-        complete_date = str(ds['date'].values)
-        gmt_time = str(ds['GMT_time'].values)
-        year = int(complete_date[:4])
-        month = int(complete_date[4:6])
-        day = int(complete_date[6:])
-        hour = int(float(gmt_time) // 1)
-        minute = int((float(gmt_time) % 1) * 60)
 
-        return year, month, day, hour, minute
+    def decode_dates(self, data_lists):
+        # decode the collected date / GMT_time values of the whole chunk at once
+        dates = np.asarray(data_lists['date'], dtype=np.float64)
+        gmt_times = np.asarray(data_lists['gmt_time'], dtype=np.float64)
+        timestamps = np.empty(dates.size, dtype=np.float64)
+        datestrs = np.zeros((dates.size, DATESTR_LENGTH), dtype=np.uint8)
+        _decode_dates(dates, gmt_times, timestamps, datestrs)
+        # rows _decode_dates skipped are all zero bytes, they come out as '', the datestr missing value
+        data_lists['timestamp'] = timestamps
+        data_lists['datestr'] = datestrs.view(f"S{DATESTR_LENGTH}").ravel().astype(str)
+
+
+    def open_dataset(self, path):
+        # NetCDF4 (HDF5) files go through h5netcdf, which takes h5py's global lock, the netcdf4 engine is not safe
+        # to open from several threads. Older NetCDF3 files are not HDF5 and are read with scipy instead.
+        # dates are decoded by hand and nothing is read twice, so skip time decoding and xarray's in-memory cache.
+        # mask_and_scale and decode_cf stay on: fill values have to become nan and char arrays strings
+        # the variables are loaded here and the file closed, so the consumer only ever sees numpy arrays
+        with open(path, 'rb') as f:
+            engine = 'h5netcdf' if f.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE else 'scipy'
+        with xr.open_dataset(path, engine=engine, decode_times=False, decode_timedelta=False, chunks=None,
+                             cache=False) as ds:
+            return ds[[name for name in READ_VARIABLES if name in ds.variables]].load()
+
+
+    def open_datasets(self, datasets):
+        # open and read files ahead of the consumer on a thread pool, so the file reads overlap with processing
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque()
+            files = iter(datasets)
+            for file in files:
+                pending.append((file, executor.submit(self.open_dataset, self.data_path / file)))
+                if len(pending) >= self.prefetch:
+                    break
+            while pending:
+                file, future = pending.popleft()
+                next_file = next(files, None)
+                if next_file is not None:
+                    pending.append((next_file, executor.submit(self.open_dataset, self.data_path / next_file)))
+                yield file, future.result()
 
 
     def initialize_variables(self):
-        string_attrs = {'orig_profile_ID': 'wod_unique_cast',
-                        'orig_cruise_id': 'originators_cruise_identifier',
-                        'access_no': 'Access_no',
-                        'platform': 'Platform',
-                        'station_no': 'Orig_Stat_Num',
-                        'instrument_type': 'dataset',
-                        'lat': 'lat',
-                        'lon': 'lon',
-                        'bottom_depth': 'Bottom_Depth',
-                        'datestr': '',
-                        'timestamp': '',
-                        'orig_filename': '',
-                        'shallowest_depth': '',
-                        'deepest_depth': '',
-                        'parent_index': '',
-                        }
-        obs_attrs = {'depth': 'z',
-                    'press': 'Pressure',
-                    'temp': 'Temperature',
-                    'psal': 'Salinity',
-                    'depth_flag': 'z_WODflag',
-                    'temp_flag': 'Temperature_WODflag',
-                    'psal_flag': 'Salinity_WODflag',
-                    }
-        data_lists = {attr: [] for attr in list(string_attrs.keys()) + list(obs_attrs.keys())}
+        data_lists = {attr: [] for attr, _, _ in STRING_ATTRS}
+        data_lists.update({attr: [] for attr in ['date', 'gmt_time', 'obs_count']})
+        # observations go into growable numpy buffers, filled up to n_obs
+        data_lists.update({attr: GrowArray(dtype) for attr, _, dtype in OBS_ATTRS})
+        self.bytes_in = 0
+        n_obs = 0
         i = 0
-        return string_attrs, obs_attrs, data_lists, i
+        return data_lists, n_obs, i
+
+
+    def get_column(self, variables, name):
+        # numba only accepts native byte order arrays
+        variable = variables.get(name)
+        if variable is None:
+            return MISSING_COLUMN
+        values = variable.values
+        return values.astype(values.dtype.newbyteorder('='), copy=False)
 
 
-    def read_raw_data(self, datasets, data_path, save_path, file_counter):
-        string_attrs, obs_attrs, data_lists, i = self.initialize_variables()
-        for file in tqdm(datasets, colour='GREEN'):
-            ds = xr.open_dataset(file)
+    def read_raw_data(self, datasets, file_counter):
+        data_lists, n_obs, i = self.initialize_variables()
+        profile_vars = [(key, value) for key, value, _ in STRING_ATTRS if value != '']
+        for file, ds in tqdm(self.open_datasets(datasets), total=len(datasets), colour='GREEN'):
+
+            # every variable is looked up and read once, through ds.variables to skip building DataArrays
+            variables = ds.variables
 
             # get observational data
-            depth_list = None
-            press_list = None
-            temp_list = None
-            psal_list = None
-            if 'z' and 'Pressure' in ds:
-                depth_list = ds['z'].values
-                press_list = ds['Pressure'].values
-                data_lists['depth'].extend(depth_list)
-                data_lists['press'].extend(press_list)
-            elif 'z' in ds and 'Pressure' not in ds:
-                depth_list = ds['z'].values
-                press_list = [np.nan] * len(depth_list)
-                data_lists['depth'].extend(depth_list)
-                data_lists['press'].extend(press_list)
-            elif 'Pressure' in ds and 'z' not in ds:
-                press_list = ds['Pressure'].values
-                depth_list = [np.nan] * press_list
-                data_lists['press'].extend(press_list)
-                data_lists['depth'].extend(depth_list)
-            else:
+            if 'z' not in variables and 'Pressure' not in variables:
                 continue
 
-            if 'z_WODflag' in ds:
-                data_lists['depth_flag'].extend(ds['z_WODflag'].values)
-            else:
-                data_lists['depth_flag'].extend([np.nan] * depth_list)
+            # missing columns come back as empty arrays and are filled with nan by _merge_profile
+            depth_list = self.get_column(variables, 'z')
+            press_list = self.get_column(variables, 'Pressure')
+            temp_list = self.get_column(variables, 'Temperature')
+            psal_list = self.get_column(variables, 'Salinity')
+            depth_flag = self.get_column(variables, 'z_WODflag')
+            temp_flag = self.get_column(variables, 'Temperature_WODflag') if temp_list.size else MISSING_COLUMN
+            psal_flag = self.get_column(variables, 'Salinity_WODflag') if psal_list.size else MISSING_COLUMN
+            n = len(depth_list) if 'z' in variables else len(press_list)
+            columns = (depth_list, press_list, temp_list, psal_list, depth_flag, temp_flag, psal_flag)
+            if any(column.size not in (0, n) for column in columns):
+                warnings.warn(f"skipping {file}: observation columns do not all have {n} values")
+                continue
 
-            if len(depth_list) > 1:
-                data_lists['shallowest_depth'].append(min(depth_list[depth_list != 0]))
-            else:
-                data_lists['shallowest_depth'].append(min(depth_list))
-            data_lists['deepest_depth'].append(max(depth_list))
-            data_lists['parent_index'].extend([i] * len(depth_list)) 
-
-            if 'Salinity' in ds:
-                psal_list = ds['Salinity'].values
-                data_lists['psal'].extend(ds['Salinity'].values)
-                if 'Salinity_WODflag' in ds:
-                    data_lists['psal_flag'].extend(ds['Salinity_WODflag'].values)
-                else:
-                    data_lists['psal_flag'].extend([np.nan] * len(psal_list))
-            else:
-                psal_list = [np.nan] * len(depth_list)
-                data_lists['psal'].extend(psal_list)
-                data_lists['psal_flag'].extend(psal_list)
-
-            if 'Temperature' in ds:
-                temp_list = ds['Temperature'].values
-                data_lists['temp'].extend(temp_list)
-                if 'Temperature_WODflag' in ds:
-                    data_lists['temp_flag'].extend(ds['Temperature_WODflag'].values)
-                else:
-                    data_lists['temp_flag'].extend([np.nan] * temp_list)
+            end = n_obs + n
+            for attr, _, _ in OBS_ATTRS:
+                data_lists[attr].resize(end)
+            _merge_profile(data_lists['depth'].buf, data_lists['press'].buf, data_lists['temp'].buf,
+                           data_lists['psal'].buf, data_lists['depth_flag'].buf, data_lists['temp_flag'].buf,
+                           data_lists['psal_flag'].buf, n_obs, n,
+                           depth_list, press_list, temp_list, psal_list, depth_flag, temp_flag, psal_flag)
+
+            # masked depths are nan, they are left out like np.nanmin / np.nanmax would
+            depths = depth_list[~np.isnan(depth_list)]
+            if depths.size == 0:
+                data_lists['shallowest_depth'].append(np.nan)
+                data_lists['deepest_depth'].append(np.nan)
             else:
-                temp_list = [np.nan] * len(depth_list)
-                data_lists['temp'].extend(temp_list)
-                data_lists['temp_flag'].extend(temp_list)
+                # shallowest ignores the surface (z == 0) unless that is all the profile has
+                nonzero = depths[depths != 0]
+                data_lists['shallowest_depth'].append(nonzero.min() if nonzero.size else depths.min())
+                data_lists['deepest_depth'].append(depths.max())
+            data_lists['obs_count'].append(n)
 
             # get metadata
-            if 'orig_filename' in ds and len(ds['orig_filename']) > 0 :
-                data_lists['orig_filename'].append(file)
+            if 'orig_filename' in variables and variables['orig_filename'].size > 0:
+                data_lists['orig_filename'].append(Path(file).name)
             else:
                 data_lists['orig_filename'].append(np.nan)
 
-            if 'date' in ds and 'GMT_time' in ds:
-                try:
-                    year, month, day, hour, minute = self.get_date(ds)
-                    datestr = datetime(year, month, day, hour, minute)
-                    data_lists['timestamp'].append(datestr.timestamp())
-                    data_lists['datestr'].append(datetime.strftime(datestr, "%Y/%m/%d %H:%M:%S"))
-                except Exception:
-                    data_lists['datestr'].append(np.nan)
-                    data_lists['timestamp'].append(np.nan)
+            # dates are decoded per chunk in decode_dates
+            if 'date' in variables and 'GMT_time' in variables:
+                data_lists['date'].append(variables['date'].values)
+                data_lists['gmt_time'].append(variables['GMT_time'].values)
             else:
-                    data_lists['datestr'].append(np.nan)
-                    data_lists['timestamp'].append(np.nan)
-
-            for key, value in string_attrs.items():
-                    if value != '':
-                        if value in ds:
-                            data_lists[key].append(ds[value].values)
-                        else:
-                            data_lists[key].append(np.nan) 
+                data_lists['date'].append(np.nan)
+                data_lists['gmt_time'].append(np.nan)
+
+            for key, value in profile_vars:
+                data_lists[key].append(variables[value].values if value in variables else np.nan)
                 
             # check if the file is too big. If so, save the file and start again
+            n_obs = end
+            self.bytes_in += n * OBS_ITEMSIZE
             i += 1
-            if self.is_variable_too_big(data_lists):
+            if (i & (FLUSH_CHECK_STRIDE - 1)) == 0 and self.is_variable_too_big():
                 for attr in data_lists:
                     print(f"attr: {attr} - len: {len(data_lists[attr])}")
                 print('-'*100)
-                self.create_dataset(data_path, save_path, data_lists, string_attrs, file_counter)
-                string_attrs, obs_attrs, data_lists, i = self.initialize_variables()
+                self.write_dataset(data_lists, file_counter)
+                data_lists, n_obs, i = self.initialize_variables()
                 file_counter += 1
-        self.create_dataset(data_path, save_path, data_lists, string_attrs, file_counter)
-
-
-    def create_dataset(self, data_path, save_path, data_list, string_attrs, file_counter):
-        if not os.path.isdir(save_path):
-            os.mkdir(save_path)
-        os.chdir(save_path)
-        ds = xr.Dataset(
-            coords=dict(
-                timestamp=(['profile'], data_list['timestamp']),
-                lat=(['profile', ], data_list['lat']),
-                lon=(['profile', ], data_list['lon']),
-            ),
-            data_vars=dict(
-                **{attr: xr.DataArray(data_list[attr], dims=['profile']) for attr in string_attrs.keys() if
-                attr not in ['lat', 'lon', 'timestamp', 'parent_index']},
-                # measurements
-                parent_index=xr.DataArray(data_list['parent_index'], dims=['obs']),
-                depth=xr.DataArray(data_list['depth'], dims=['obs']),
-                depth_flag=xr.DataArray(data_list['depth_flag'], dims=['obs']),
-                press=xr.DataArray(data_list['press'], dims=['obs']),
-                temp=xr.DataArray(data_list['temp'], dims=['obs']),
-                temp_flag=xr.DataArray(data_list['temp_flag'], dims=['obs']),
-                psal=xr.DataArray(data_list['psal'], dims=['obs']),
-                psal_flag=xr.DataArray(data_list['psal_flag'], dims=['obs']),
-            ),
-            attrs=dict(
-                dataset_name="WOD_2022",
-                creation_date=str(datetime.now().strftime("%Y-%m-%d %H:%M")),
-            ),
-        )
-        ds.to_netcdf(f"WOD_2022_{file_counter}_raw.nc")
-        os.chdir(data_path)
-
-
-    def run(self, data_path, save_path, datasets):
-        os.chdir(data_path)
+        self.write_dataset(data_lists, file_counter)
+        self.wait_for_writes()
+
+
+    def write_dataset(self, data_list, file_counter):
+        # the chunk is written on the writer thread while the next one is read. Waiting for the previous
+        # write first keeps at most one finished chunk in memory.
+        # dates are decoded here: launching numba's parallel threading layer from a non-main thread hangs at exit
+        self.decode_dates(data_list)
+        self.wait_for_writes()
+        self.pending_writes.append(self.writer.submit(self.create_dataset, data_list, file_counter))
+
+
+    def wait_for_writes(self):
+        while self.pending_writes:
+            self.pending_writes.pop(0).result()
+
+
+    def write_variable(self, nc, name, values, dim, fill_value=None):
+        # the whole column goes out in a single put, numeric columns are chunked and compressed along their dimension
+        kwargs = {}
+        if values.dtype.kind == 'S':
+            # fixed width bytes are stored as a char array, the same layout xarray used for them
+            width = max(values.dtype.itemsize, 1)
+            if f'string{width}' not in nc.dimensions:
+                nc.createDimension(f'string{width}', width)
+            variable = nc.createVariable(name, 'S1', (dim, f'string{width}'))
+            variable[:] = values.astype(f'S{width}').view('S1').reshape(values.size, width)
+            return variable
+        if values.dtype.kind == 'U':
+            variable = nc.createVariable(name, str, (dim,))
+            variable[:] = values.astype(object)
+            return variable
+        if values.size > 0:
+            chunk_size = OBS_CHUNK_SIZE if dim == 'obs' else PROFILE_CHUNK_SIZE
+            kwargs.update(zlib=True, complevel=4, shuffle=True, chunksizes=(min(values.size, chunk_size),))
+        if fill_value is not None:
+            kwargs['fill_value'] = fill_value
+        variable = nc.createVariable(name, values.dtype, (dim,), **kwargs)
+        variable[:] = values
+        return variable
+
+
+    def get_profile_column(self, values, dtype):
+        # typed array for a per-profile list at the column's STRING_ATTRS dtype, the same in every chunk, so no
+        # object arrays and chunks concatenate cleanly.
+        # read_raw_data appends nan for a value the file does not have, it becomes the column's MISSING_VALUES entry
+        missing = MISSING_VALUES[np.dtype(dtype).kind]
+        values = [np.asarray(value) for value in values]
+        return np.array([missing if value.dtype.kind == 'f' and np.isnan(value) else value for value in values],
+                        dtype=dtype)
+
+
+    def create_dataset(self, data_list, file_counter):
+        self.save_path.mkdir(parents=True, exist_ok=True)
+        profile_columns = {attr: self.get_profile_column(data_list[attr], dtype) for attr, _, dtype in STRING_ATTRS}
+        obs_columns = {'parent_index': np.repeat(np.arange(len(data_list['obs_count'])), data_list['obs_count'])}
+        obs_columns.update({attr: data_list[attr].data for attr, _, _ in OBS_ATTRS})
+
+        if self.shard_id is None:
+            filename = f"WOD_2022_{file_counter}_raw.nc"
+        else:
+            filename = f"WOD_2022_{self.shard_id}_{file_counter}_raw.nc"
+        # written with h5netcdf's netCDF4-style API, the columns are already final so xarray's encoding pipeline is
+        # not needed. This runs on the writer thread next to the h5netcdf reads, going through h5py keeps every
+        # HDF5 call behind its global lock, which the netCDF4 library would not take part in
+        with h5netcdf.legacyapi.Dataset(self.save_path / filename, 'w') as nc:
+            nc.setncattr('dataset_name', "WOD_2022")
+            nc.setncattr('creation_date', str(datetime.now().strftime("%Y-%m-%d %H:%M")))
+            nc.createDimension('profile', len(data_list['obs_count']))
+            nc.createDimension('obs', len(obs_columns['parent_index']))
+            for attr, values in profile_columns.items():
+                variable = self.write_variable(nc, attr, values, 'profile', MISSING_VALUES[values.dtype.kind])
+                # lat, lon and timestamp stay the profile coordinates when the file is opened with xarray
+                if attr not in ['lat', 'lon', 'timestamp']:
+                    variable.setncattr('coordinates', 'lat lon timestamp')
+            self.write_variable(nc, 'parent_index', obs_columns.pop('parent_index'), 'obs')
+            for attr, values in obs_columns.items():
+                self.write_variable(nc, attr, values, 'obs', FLAG_FILL_VALUE if values.dtype.kind == 'i' else np.nan)
+
+
+    def run(self, data_path, save_path, datasets, shard_id=None):
+        # datasets are file names inside data_path, they are joined to it when opened.
+        # absolute paths instead of os.chdir, the working directory is shared by every thread
+        self.data_path = Path(data_path).resolve()
+        self.save_path = Path(save_path).resolve()
+        self.shard_id = shard_id
         file_counter = 0
-        self.read_raw_data(datasets, data_path, save_path, file_counter)
+        self.pending_writes = []
+        with ThreadPoolExecutor(max_workers=1) as self.writer:
+            self.read_raw_data(datasets, file_counter)
+
+
+def run_shard(data_path, save_path, datasets, shard_id, flush_threshold_bytes):
+    WODReader(flush_threshold_bytes=flush_threshold_bytes).run(data_path, save_path, datasets, shard_id)
 
 
 def main():
-    wod_reader = WODReader()
-    data_path = '/mnt/storage6/caio/AW_CAA/CTD_DATA/WOD_2022/original_data/netcdf/ocldb1663004073.18805.CTD'
-    save_path = '/mnt/storage6/caio/AW_CAA/CTD_DATA/WOD_2022/ncfiles_raw'
-    os.chdir(data_path)
-    datasets = [file for file in os.listdir() if file.endswith(".nc")]
-
-    # dataset_splits = len(datasets) // 6
-    # threads = []
-    # for i in range(6):
-    #     start_index = i * dataset_splits
-    #     end_index = (i + 1) * dataset_splits if i < 6 - 1 else len(datasets)
-    #     t = threading.Thread(target=wod_reader.run, args=(data_path, save_path, datasets[start_index:end_index], i))
-    #     threads.append(t)
-    #     t.start()
-
-    # for t in threads:
-    #     t.join()
-    wod_reader.run(data_path=data_path, save_path=save_path, datasets=datasets)
+    data_path = Path('/mnt/storage6/caio/AW_CAA/CTD_DATA/WOD_2022/original_data/netcdf/ocldb1663004073.18805.CTD')
+    save_path = Path('/mnt/storage6/caio/AW_CAA/CTD_DATA/WOD_2022/ncfiles_raw')
+    datasets = [path.name for path in sorted(data_path.glob('*.nc'))]
+
+    # one process per shard, the per-file work is python bound so threads would serialize on the GIL
+    n_shards = 6
+    dataset_splits = len(datasets) // n_shards
+    shards = []
+    for i in range(n_shards):
+        start_index = i * dataset_splits
+        end_index = (i + 1) * dataset_splits if i < n_shards - 1 else len(datasets)
+        shards.append(datasets[start_index:end_index])
+
+    with ProcessPoolExecutor(max_workers=n_shards) as executor:
+        # the shards share the host budget, each holding up to two chunks
+        flush_threshold_bytes = FLUSH_THRESHOLD_BYTES // (2 * n_shards)
+        list(executor.map(run_shard, [data_path] * n_shards, [save_path] * n_shards, shards, range(n_shards),
+                          [flush_threshold_bytes] * n_shards))
 
 
 if __name__ == "__main__":